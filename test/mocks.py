@@ -32,20 +32,41 @@ class FakeConsumer:
 
 
 class FakeProducer:
-    def __init__(self):
+    def __init__(self, buffer_errors=0):
         self.messages = []
+        # Number of produce calls that fail because the queue is full
+        self.buffer_errors = buffer_errors
 
     def produce(self, topic, msg):
+        if self.buffer_errors:
+            self.buffer_errors -= 1
+            raise BufferError
         log.info(f'producing {msg}')
         self.messages.append(msg)
 
+    def poll(self, timeout=None):
+        return 0
+
+
+class FakeStreamReader:
+    def __init__(self, body):
+        self.body = body
+
+    async def iter_chunked(self, n):
+        for idx in range(0, len(self.body), n):
+            yield self.body[idx:idx + n]
+
 
 class FakeImageResponse:
-    def __init__(self, status=200, corrupt=False):
+    def __init__(self, status=200, corrupt=False, body=None):
         self.status = status
         self.corrupt = False
+        self.body = body
+        self.headers = {'Content-Length': str(len(self._body()))}
 
-    async def read(self):
+    def _body(self):
+        if self.body is not None:
+            return self.body
         # 1024 x 768 sample image with exif tag 'artist = unknown'
         if self.corrupt:
             location = 'test/test_worker.py'
@@ -54,6 +75,16 @@ class FakeImageResponse:
         with open(location, 'rb') as f:
             return f.read()
 
+    @property
+    def content(self):
+        return FakeStreamReader(self._body())
+
+    async def read(self):
+        return self._body()
+
+    def close(self):
+        pass
+
 
 class FakeAioResponse:
     def __init__(self, status, body):
@@ -1,17 +1,29 @@
 import json
+import os
 import pytest
+import signal
+import struct
+import warnings
+import zlib
 import asyncio
 import logging as log
 import concurrent.futures
-from worker.message import AsyncProducer
+from functools import partial
+from io import BytesIO
+from worker.message import AsyncProducer, exif_message
 from test.mocks import (
     FakeConsumer, FakeAioSession, FakeRedis, AioNetworkSimulatingSession,
-    FakeProducer
+    FakeProducer, FakeImageResponse
 )
 from worker.stats_reporting import StatsManager
-from worker.image import process_image
+from worker.image import (
+    process_image, _read_body, _get_img_pool, _cpu_pipeline
+)
 from worker.rate_limit import RateLimitedClientSession
-from PIL import Image
+from worker.util import jpeg_quality
+from worker import settings
+from PIL import Image, __version__ as PILLOW_VERSION
+from PIL.TiffImagePlugin import IFDRational
 
 
 log.basicConfig(level=log.DEBUG)
@@ -175,6 +187,10 @@ def test_quality_messaging(producer_fixture):
         assert field in parsed
         assert parsed[field] is not None
         assert parsed[field] != ''
+    with open('test/test_image.jpg', 'rb') as f:
+        assert parsed['filesize'] == len(f.read())
+    assert parsed['width'] == 1024
+    assert parsed['height'] == 768
 
 
 def test_exif_messaging(producer_fixture):
@@ -188,3 +204,266 @@ def test_exif_messaging(producer_fixture):
 def test_retries(producer_fixture):
     _, retries = producer_fixture
     assert retries.messages == []
+
+
+def test_jpeg_quality_estimate():
+    img = Image.open('test/test_image.jpg')
+    for quality in [10, 50, 75, 95]:
+        buffer = BytesIO()
+        img.save(buffer, format='JPEG', quality=quality)
+        assert jpeg_quality(buffer.getvalue()) == quality
+    with open('test/corrupt.jpg', 'rb') as f:
+        assert jpeg_quality(f.read()) is None
+
+
+@pytest.mark.asyncio
+async def test_read_body_ignores_wrong_content_length():
+    resp = FakeImageResponse()
+    with open('test/test_image.jpg', 'rb') as f:
+        expected = f.read()
+    for length in ['', '0', '10', str(len(expected) * 2)]:
+        resp.headers['Content-Length'] = length
+        assert await _read_body(resp, len(expected) * 2) == expected
+
+
+@pytest.mark.asyncio
+async def test_producer_retries_when_queue_full():
+    kafka = FakeProducer(buffer_errors=2)
+    producer = AsyncProducer(kafka, 'foo')
+    producer.enqueue_message({'identifier': 'a'})
+    producer.enqueue_message({'identifier': 'b'})
+    producer_task = asyncio.create_task(producer.listen())
+    try:
+        await asyncio.wait_for(producer_task, 1)
+    except concurrent.futures.TimeoutError:
+        pass
+    parsed = [json.loads(str(msg, 'utf-8')) for msg in kafka.messages]
+    assert [msg['identifier'] for msg in parsed] == ['a', 'b']
+
+
+def test_exif_coerces_unserializable_values():
+    exif = Image.Exif()
+    exif[0x13b] = 'unknown'
+    exif[0x11a] = IFDRational(72, 1)
+    exif[0x927c] = b'\x00\x01'
+    buffer = BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, format='JPEG', exif=exif.tobytes())
+    buffer.seek(0)
+    msg = exif_message(Image.open(buffer), 'ident')
+    assert msg['exif'] == {'0x13b': 'unknown', '0x11a': 72.0}
+
+
+@pytest.mark.asyncio
+async def test_producer_publishes_early_at_high_watermark():
+    kafka = FakeProducer()
+    producer = AsyncProducer(kafka, 'foo', frequency=60, high_watermark=2)
+    producer_task = asyncio.create_task(producer.listen())
+    await asyncio.sleep(0.01)
+    producer.enqueue_message({'identifier': 'a'})
+    producer.enqueue_message({'identifier': 'b'})
+    await asyncio.sleep(0.01)
+    producer_task.cancel()
+    try:
+        await producer_task
+    except asyncio.CancelledError:
+        pass
+    assert len(kafka.messages) == 2
+
+
+@pytest.mark.asyncio
+async def test_producer_keeps_messages_enqueued_while_publishing():
+    # The first produce call fails, so listen() backs off mid-batch while
+    # another message arrives.
+    kafka = FakeProducer(buffer_errors=1)
+    producer = AsyncProducer(kafka, 'foo', frequency=0.01)
+    producer.enqueue_message({'identifier': 'a'})
+    producer_task = asyncio.create_task(producer.listen())
+    await asyncio.sleep(0.01)
+    producer.enqueue_message({'identifier': 'b'})
+    await asyncio.sleep(0.5)
+    producer_task.cancel()
+    try:
+        await producer_task
+    except asyncio.CancelledError:
+        pass
+    parsed = [json.loads(str(msg, 'utf-8')) for msg in kafka.messages]
+    assert [msg['identifier'] for msg in parsed] == ['a', 'b']
+
+
+@pytest.mark.asyncio
+async def test_skips_oversized_images(monkeypatch):
+    monkeypatch.setattr('worker.settings.MAX_IMAGE_BYTES', 1024)
+    redis = FakeRedis()
+    stats = StatsManager(redis)
+    await process_image(
+        persister=validate_thumbnail,
+        session=RateLimitedClientSession(FakeAioSession(), redis),
+        url='https://example.gov/hello.jpg',
+        identifier='4bbfe191-1cca-4b9e-aff0-1d3044ef3f2d',
+        stats=stats,
+        source='example',
+        semaphore=asyncio.BoundedSemaphore(1000)
+    )
+    assert redis.store['resize_errors:example:TooLarge'] == 1
+    assert 'num_resized' not in redis.store
+    # Bodies that exceed the limit without advertising their size are
+    # abandoned as well.
+    resp = FakeImageResponse()
+    resp.headers = {}
+    assert await _read_body(resp, 1024) is None
+
+
+@pytest.mark.asyncio
+async def test_recovers_from_broken_process_pool():
+    redis = FakeRedis()
+    # Enough rate limit tokens for every request
+    await redis.set('currtokens:example', 10)
+    stats = StatsManager(redis)
+    retry_producer = FakeProducer()
+    producer = AsyncProducer(retry_producer, 'foo')
+    process = partial(
+        process_image,
+        persister=validate_thumbnail,
+        session=RateLimitedClientSession(FakeAioSession(), redis),
+        url='https://example.gov/hello.jpg',
+        identifier='4bbfe191-1cca-4b9e-aff0-1d3044ef3f2d',
+        stats=stats,
+        source='example',
+        semaphore=asyncio.BoundedSemaphore(1000),
+        retry_producer=producer
+    )
+    await process()
+    # Simulate the OOM killer taking out every worker process.
+    pool = _get_img_pool()
+    for pid in list(pool._processes):
+        os.kill(pid, signal.SIGKILL)
+    await process()
+    assert redis.store['resize_errors:example:BrokenProcessPool'] == 1
+    assert producer._messages
+    # The next image is processed by a fresh pool.
+    await process()
+    assert _get_img_pool() is not pool
+    assert len(redis.store['statuslast50req:example']) == 3
+    assert redis.store['statuslast50req:example'][-1] == 200
+
+
+@pytest.mark.asyncio
+async def test_records_truncated_images():
+    with open('test/test_image.jpg', 'rb') as f:
+        truncated = f.read()[:2000]
+    redis = FakeRedis()
+    stats = StatsManager(redis)
+    session = FakeAioSession(response=FakeImageResponse(body=truncated))
+    await process_image(
+        persister=validate_thumbnail,
+        session=RateLimitedClientSession(session, redis),
+        url='https://example.gov/hello.jpg',
+        identifier='4bbfe191-1cca-4b9e-aff0-1d3044ef3f2d',
+        stats=stats,
+        source='example',
+        semaphore=asyncio.BoundedSemaphore(1000)
+    )
+    # Pillow only distinguishes a truncated header from an unknown format
+    # since 8.2.
+    if tuple(map(int, PILLOW_VERSION.split('.')[:2])) >= (8, 2):
+        code = 'DecodeError'
+    else:
+        code = 'UnidentifiedImageError'
+    assert redis.store[f'resize_errors:example:{code}'] == 1
+    assert 'num_resized' not in redis.store
+
+
+def _png_header(width, height):
+    """ A PNG with a header but no pixel data. """
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    chunks = b''
+    for tag, data in [(b'IHDR', ihdr), (b'IEND', b'')]:
+        crc = zlib.crc32(tag + data)
+        chunks += struct.pack('>I', len(data)) + tag + data
+        chunks += struct.pack('>I', crc)
+    return b'\x89PNG\r\n\x1a\n' + chunks
+
+
+def test_rejects_images_over_pixel_limit():
+    # 150M pixels is below the point where Pillow itself raises.
+    raw = _png_header(15000, 10000)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+        with pytest.raises(Image.DecompressionBombError):
+            _cpu_pipeline(raw, 'ident')
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_requests_dont_hold_semaphore():
+    # Errors from the request itself are reported without waiting for one of
+    # the in-flight slots, which are all taken here.
+    redis = FakeRedis()
+    stats = StatsManager(redis)
+    semaphore = asyncio.BoundedSemaphore(1)
+    await semaphore.acquire()
+    session = FakeAioSession(status=404)
+    await asyncio.wait_for(
+        process_image(
+            persister=validate_thumbnail,
+            session=RateLimitedClientSession(session, redis),
+            url='https://example.gov/hello.jpg',
+            identifier='4bbfe191-1cca-4b9e-aff0-1d3044ef3f2d',
+            stats=stats,
+            source='example',
+            semaphore=semaphore
+        ),
+        1
+    )
+    assert redis.store['resize_errors:example:404'] == 1
+
+
+def _fake_cgroup(monkeypatch, files):
+    monkeypatch.setattr(
+        settings, '_read_cgroup_file', lambda path: files.get(path)
+    )
+
+
+def test_memory_limit_honors_cgroups(monkeypatch):
+    monkeypatch.setattr(settings, '_physical_memory_mb', lambda: 16384)
+    v2 = '/sys/fs/cgroup/memory.max'
+    v1 = '/sys/fs/cgroup/memory/memory.limit_in_bytes'
+    _fake_cgroup(monkeypatch, {v2: ['2147483648']})
+    assert settings._memory_limit_mb() == 2048
+    _fake_cgroup(monkeypatch, {v2: ['max']})
+    assert settings._memory_limit_mb() == 16384
+    _fake_cgroup(monkeypatch, {v1: ['536870912']})
+    assert settings._memory_limit_mb() == 512
+    # cgroup v1 reports no limit as a number larger than physical memory.
+    _fake_cgroup(monkeypatch, {v1: ['9223372036854771712']})
+    assert settings._memory_limit_mb() == 16384
+    _fake_cgroup(monkeypatch, {})
+    assert settings._memory_limit_mb() == 16384
+
+
+def test_cpu_limit_honors_cgroups(monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(8)))
+    v2 = '/sys/fs/cgroup/cpu.max'
+    quota = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+    period = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+    _fake_cgroup(monkeypatch, {v2: ['150000', '100000']})
+    assert settings._cpu_limit() == 2
+    _fake_cgroup(monkeypatch, {v2: ['max', '100000']})
+    assert settings._cpu_limit() == 8
+    _fake_cgroup(monkeypatch, {quota: ['50000'], period: ['100000']})
+    assert settings._cpu_limit() == 1
+    _fake_cgroup(monkeypatch, {quota: ['400000'], period: ['100000']})
+    assert settings._cpu_limit() == 4
+    # A quota of -1 means no limit in cgroup v1.
+    _fake_cgroup(monkeypatch, {quota: ['-1'], period: ['100000']})
+    assert settings._cpu_limit() == 8
+    # The quota can't raise the limit above the CPUs we are allowed to use.
+    _fake_cgroup(monkeypatch, {v2: ['1600000', '100000']})
+    assert settings._cpu_limit() == 8
+
+
+def test_max_inflight_fits_memory_budget():
+    assert settings._max_inflight(4096, 5, 3000) == 819
+    assert settings._max_inflight(4096, 2.5, 3000) == 1638
+    # Capped by the number of tasks, and never below one.
+    assert settings._max_inflight(100000, 5, 3000) == 3000
+    assert settings._max_inflight(1, 5, 3000) == 1
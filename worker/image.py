@@ -1,15 +1,27 @@
 import asyncio
 import aiohttp
+import concurrent.futures
+import cv2
 import logging as log
+import multiprocessing
+import numpy as np
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial
 from io import BytesIO
-from PIL import Image, UnidentifiedImageError
+from PIL import Image, ImageFile, UnidentifiedImageError
 from worker import settings as settings
-from worker.message import notify_quality, notify_exif, notify_retry, notify_404
+from worker.message import (
+    quality_message, exif_message, notify_retry, notify_404
+)
 from worker.stats_reporting import StatsManager
 
 NO_RATE_TOKEN = 'NoRateToken'
 SERVER_DISCONNECTED = 'ServerDisconnected'
+TIMEOUT = 'Timeout'
+TOO_LARGE = 'TooLarge'
+DECOMPRESSION_BOMB = 'DecompressionBomb'
+BROKEN_POOL = 'BrokenProcessPool'
+DECODE_ERROR = 'DecodeError'
 
 RETRY_CODES = {
     400,
@@ -17,11 +29,77 @@ RETRY_CODES = {
     403,
     429,
     500,
-    SERVER_DISCONNECTED
+    SERVER_DISCONNECTED,
+    TIMEOUT,
+    BROKEN_POOL
 }
 
 MAX_RETRIES = 1
 
+# Size of the chunks read from the network when downloading an image.
+CHUNK_SIZE = 64 * 1024
+
+# Thumbnail encoding options, resolved once at import instead of per image.
+# Optimized and progressive JPEGs need extra passes over the image, so both
+# are kept off explicitly.
+JPEG_QUALITY = 50
+_TARGET_WIDTH, _TARGET_HEIGHT = settings.TARGET_RESOLUTION
+_DECODE_FLAGS = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+_CV_JPEG_PARAMS = [
+    int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY,
+    int(cv2.IMWRITE_JPEG_OPTIMIZE), 0,
+    int(cv2.IMWRITE_JPEG_PROGRESSIVE), 0
+]
+_PIL_JPEG_OPTS = dict(
+    format='JPEG', quality=JPEG_QUALITY, optimize=False, progressive=False
+)
+
+# Images with more pixels than this are rejected before they are decoded.
+# Pillow only raises above twice its MAX_IMAGE_PIXELS, so _cpu_pipeline
+# enforces the limit itself.
+MAX_IMAGE_PIXELS = 100000000
+
+
+def _init_worker():
+    """ Configure the image libraries in each image processing process. """
+    # Parallelism comes from the process pool; OpenCV's own thread pool would
+    # oversubscribe the CPUs.
+    cv2.setNumThreads(1)
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    # Let the Pillow fallback thumbnail images whose pixel data ends early.
+    # Images truncated within their headers still fail to open and are
+    # recorded as errors.
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+# Decoding and resizing are CPU-bound, so they run in separate processes to
+# avoid contending for the GIL with each other and the event loop. The pool is
+# created on first use and replaced if one of its processes dies.
+_img_pool = None
+
+
+def _get_img_pool():
+    global _img_pool
+    if _img_pool is None:
+        # Forking would copy the event loop's resolver and executor threads
+        # into the children, so the workers are started from a clean server
+        # process instead.
+        _img_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=settings.IMAGE_PROCESSES,
+            mp_context=multiprocessing.get_context('forkserver'),
+            initializer=_init_worker
+        )
+    return _img_pool
+
+
+def _discard_img_pool(pool):
+    """ Drop a broken pool so that the next image gets a fresh one. """
+    global _img_pool
+    # A broken pool has already been torn down by its management thread;
+    # calling shutdown() on it can race with that teardown on Python 3.7.
+    if _img_pool is pool:
+        _img_pool = None
+
 
 async def _handle_error(
         retry_producer, rot_producer, stats, identifier, source, url,
@@ -48,7 +126,8 @@ async def process_image(
     Get an image, collect dimensions metadata, thumbnail it, and persist it.
     :param stats: A StatsManager for recording task statuses.
     :param source: Used to determine rate limit policy. Example: flickr, behance
-    :param semaphore: Limits concurrent execution of process_image tasks
+    :param semaphore: Limits the number of images being downloaded and
+    processed at once.
     :param identifier: Our identifier for the image at the URL.
     :param persister: The function defining image persistence. It
     should do something like save an image to disk, or upload it to
@@ -62,46 +141,161 @@ async def process_image(
     :param attempts: The number of times we have tried and failed to download
     the image.
     """
+    loop = asyncio.get_running_loop()
+    report_err = partial(
+        _handle_error, retry_producer, rot_producer, stats, identifier,
+        source, url, attempts=attempts
+    )
+    try:
+        img_resp = await session.get(url, source)
+    except aiohttp.client_exceptions.ServerDisconnectedError:
+        await report_err(err_code='ServerDisconnected')
+        return
+    except asyncio.TimeoutError:
+        await report_err(err_code=TIMEOUT)
+        return
+    if not img_resp:
+        await report_err(err_code='NoRateToken')
+        return
+    elif img_resp.status >= 400:
+        await report_err(err_code=img_resp.status)
+        return
+    # The semaphore bounds the number of images held in memory, so it is
+    # only taken once the rate limiter has let the request through; tasks
+    # waiting for a token from a slow source must not hold up other sources.
     async with semaphore:
-        loop = asyncio.get_event_loop()
-        report_err = partial(
-            _handle_error, retry_producer, rot_producer, stats, identifier,
-            source, url, attempts=attempts
-        )
         try:
-            img_resp = await session.get(url, source)
-        except aiohttp.client_exceptions.ServerDisconnectedError:
-            await report_err(err_code='ServerDisconnected')
-            return
-        if not img_resp:
-            await report_err(err_code='NoRateToken')
+            raw = await _read_body(img_resp, settings.MAX_IMAGE_BYTES)
+        except asyncio.TimeoutError:
+            await report_err(err_code=TIMEOUT)
             return
-        elif img_resp.status >= 400:
-            await report_err(err_code=img_resp.status)
+        if raw is None:
+            img_resp.close()
+            await report_err(err_code=TOO_LARGE)
             return
-        buffer = BytesIO(await img_resp.read())
+        pool = _get_img_pool()
         try:
-            img = await loop.run_in_executor(None, partial(Image.open, buffer))
-            if metadata_producer:
-                notify_quality(img, buffer, identifier, metadata_producer)
-                notify_exif(img, identifier, metadata_producer)
+            thumb, quality_msg, exif_msg = await loop.run_in_executor(
+                pool, _cpu_pipeline, raw, identifier
+            )
+        except BrokenProcessPool:
+            # A worker process died, likely from running out of memory or a
+            # crash in a native decoder.
+            log.warning('Image processing pool broke; replacing it')
+            _discard_img_pool(pool)
+            await report_err(err_code=BROKEN_POOL)
+            return
         except UnidentifiedImageError:
             await report_err(err_code='UnidentifiedImageError')
             return
-        thumb = await loop.run_in_executor(
-            None, partial(thumbnail_image, img)
-        )
+        except OSError:
+            # Pillow and the thumbnailer raise OSError for images that can't
+            # be decoded, such as those truncated within their headers.
+            await report_err(err_code=DECODE_ERROR)
+            return
+        except Image.DecompressionBombError:
+            await report_err(err_code=DECOMPRESSION_BOMB)
+            return
+        if metadata_producer:
+            metadata_producer.enqueue_message(quality_msg)
+            if exif_msg:
+                metadata_producer.enqueue_message(exif_msg)
         await loop.run_in_executor(
             None, partial(persister, img=thumb, identifier=identifier)
         )
-        await stats.record_success(source)
+    await stats.record_success(source)
+
+
+async def _read_body(resp, max_size):
+    """
+    Stream a response body into a single buffer. When the server sends a
+    Content-Length, the buffer is allocated up front and filled in place, so
+    the body is never copied into an intermediate bytes object.
+
+    :param resp: The aiohttp response.
+    :param max_size: The largest body to accept, in bytes.
+    :return: The body, or None if it is larger than max_size. Oversized
+    bodies are abandoned without being downloaded when the server advertises
+    their size.
+    """
+    size = int(resp.headers.get('Content-Length') or 0)
+    if size > max_size:
+        return None
+    buf = bytearray(size)
+    offset = 0
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        end = offset + len(chunk)
+        if end > max_size:
+            return None
+        # Writes within the preallocated space happen in place; the buffer
+        # grows if the server sent more than it advertised.
+        buf[offset:end] = chunk
+        offset = end
+    del buf[offset:]
+    return buf
+
+
+def _cpu_pipeline(raw: bytes, identifier):
+    """
+    Do all of the CPU-bound work for an image in a single executor call:
+    collect its metadata and thumbnail it.
+
+    :param raw: The encoded image.
+    :param identifier: Our identifier for the image.
+    :return: A tuple of the thumbnail, the quality metadata message, and the
+    EXIF metadata message (None if the image has no EXIF tags).
+    """
+    # Image.open only parses the headers, which is all the metadata needs.
+    # Pixels are decoded once, by OpenCV in thumbnail_image, so img.load()
+    # is deliberately never called.
+    img = Image.open(BytesIO(raw))
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(
+            f'Image size ({width * height} pixels) exceeds limit of '
+            f'{MAX_IMAGE_PIXELS} pixels'
+        )
+    quality_msg = quality_message(img, raw, identifier)
+    exif_msg = exif_message(img, identifier)
+    thumb = thumbnail_image(raw, img)
+    return thumb, quality_msg, exif_msg
+
+
+def thumbnail_image(buf: bytes, img: Image):
+    """
+    Downscale an encoded image to fit within the target resolution and
+    re-encode it as a JPEG.
+
+    OpenCV is used for decoding, resizing, and encoding because it is several
+    times faster than Pillow. Formats that OpenCV can't decode (such as GIF)
+    fall back to Pillow.
+
+    :param buf: The encoded image.
+    :param img: The same image, already opened with Pillow. It is only
+    decoded if OpenCV can't handle the format.
+    """
+    arr = np.frombuffer(buf, np.uint8)
+    pixels = cv2.imdecode(arr, _DECODE_FLAGS)
+    if pixels is None:
+        return _thumbnail_image_pil(img)
+    height, width = pixels.shape[:2]
+    scale = min(_TARGET_WIDTH / width, _TARGET_HEIGHT / height, 1.0)
+    if scale < 1.0:
+        size = (max(round(width * scale), 1), max(round(height * scale), 1))
+        pixels = cv2.resize(pixels, size, interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode('.jpg', pixels, _CV_JPEG_PARAMS)
+    if not ok:
+        raise OSError('OpenCV failed to encode the thumbnail')
+    return BytesIO(encoded.tobytes())
 
 
-def thumbnail_image(img: Image):
-    img.thumbnail(size=settings.TARGET_RESOLUTION, resample=Image.NEAREST)
+def _thumbnail_image_pil(img: Image):
+    img.thumbnail(
+        size=(_TARGET_WIDTH, _TARGET_HEIGHT), resample=Image.BILINEAR
+    )
     output = BytesIO()
     if img.mode != 'RGB':
         img = img.convert('RGB')
-    img.save(output, format='JPEG', quality=50)
+    img.save(output, **_PIL_JPEG_OPTS)
     output.seek(0)
     return output
@@ -1,12 +1,22 @@
 import asyncio
-import json
 import logging as log
+import orjson
+import random
 import time
-import wand.image
 import datetime as dt
-from wand.exceptions import WandException
 
 from PIL import Image
+from PIL.TiffImagePlugin import IFDRational
+from worker.util import jpeg_quality
+
+MAX_PRODUCE_ATTEMPTS = 10
+# Yield to the event loop once every 256 published messages.
+YIELD_MASK = 0xff
+
+
+def _backoff(attempt):
+    """ Exponential backoff with jitter, capped at 5 seconds. """
+    return min(0.1 * 2 ** attempt, 5) + random.random() * 0.1
 
 
 class AsyncProducer:
@@ -20,94 +30,126 @@ class AsyncProducer:
     together and intermittently send them to Kafka synchronously. Launch
     `MetadataProducer.listen` as an asyncio task to do this.
     """
-    def __init__(self, producer, topic_name, frequency=60):
+    def __init__(self, producer, topic_name, frequency=60,
+                 high_watermark=10000):
         """
         :param producer: A pykafka producer.
         :param frequency: How often to publish queued events.
+        :param high_watermark: Publish early once this many events are queued.
         """
         self.frequency = frequency
         self.producer = producer
         self.topic_name = topic_name
+        self.high_watermark = high_watermark
         self._messages = []
+        self._wake = asyncio.Event()
 
     def enqueue_message(self, msg: dict):
         try:
-            _msg_json = json.dumps(msg)
-            _msg = bytes(_msg_json, 'utf-8')
+            _msg = orjson.dumps(msg)
         except TypeError:
             ident = msg.get('identifier', '')
             log.warning(f'Failed to encode message with keys: '
                         f'{list([msg.keys()])}. Identifier: {ident}')
             return
         self._messages.append(_msg)
+        if len(self._messages) >= self.high_watermark:
+            self._wake.set()
 
     async def listen(self):
         """ Intermittently publish queued events to Kafka. """
         while True:
-            queue_size = len(self._messages)
+            # Swap in a fresh queue before publishing so that messages
+            # enqueued while we yield to other tasks go out next round.
+            batch = self._messages
+            self._messages = []
+            queue_size = len(batch)
             if queue_size:
-                log.info(f'Publishing {queue_size} events to {self.topic_name}')
+                log.info(
+                    'Publishing %d events to %s', queue_size, self.topic_name
+                )
                 start = time.monotonic()
-                for msg in self._messages:
-                    produce_attempts = 0
-                    while produce_attempts < 10:
+                for idx, msg in enumerate(batch):
+                    if idx & YIELD_MASK == 0:
+                        # Serve delivery reports so the local queue drains
+                        # before it fills up, and let other tasks run.
+                        self.producer.poll(0)
+                        await asyncio.sleep(0)
+                    for attempt in range(MAX_PRODUCE_ATTEMPTS):
                         try:
                             self.producer.produce(self.topic_name, msg)
+                            break
                         except BufferError:
-                            produce_attempts += 1
                             self.producer.poll(1)
                             # Yield to other tasks and try again later.
                             log.info(
-                                f'AsyncProducer yielding due to overload.'
-                                f' Attempts so far: {produce_attempts}'
+                                'AsyncProducer yielding due to overload.'
+                                ' Attempts so far: %d', attempt + 1
                             )
-                            await asyncio.sleep(5)
-                        break
+                            await asyncio.sleep(_backoff(attempt))
+                    else:
+                        log.warning(
+                            'Dropped message after %d attempts to publish to '
+                            '%s', MAX_PRODUCE_ATTEMPTS, self.topic_name
+                        )
                 rate = queue_size / (time.monotonic() - start)
-                self._messages = []
-                log.info(f'publish_rate={rate}/s')
-            await asyncio.sleep(self.frequency)
+                log.info('publish_rate=%s/s', rate)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.frequency)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
 
 
 def parse_message(msg):
     try:
-        decoded = json.loads(str(msg.value(), 'utf-8'))
-    except json.JSONDecodeError:
+        decoded = orjson.loads(msg.value())
+    except orjson.JSONDecodeError:
         log.error(f'Failed to parse inbound message {msg}: ', exc_info=True)
         decoded = None
     return decoded
 
 
-def notify_quality(img: Image, buffer, identifier, metadata_producer):
+def quality_message(img: Image, buf: bytes, identifier):
     """ Collect quality metadata. """
-    height, width = img.size
-    filesize = buffer.getbuffer().nbytes
-    buffer.seek(0)
-    try:
-        compression_quality = wand.image.Image(file=buffer).compression_quality
-    except WandException:
-        compression_quality = None
-    metadata_producer.enqueue_message(
-        {
-            'height': height,
-            'width': width,
-            'identifier': identifier,
-            'filesize': filesize,
-            'compression_quality': compression_quality
-        }
-    )
-
-
-def notify_exif(img: Image, identifier, metadata_producer):
-    if 'exif' in img.info:
-        exif = {hex(k): v for k, v in img.getexif().items()}
-        if exif:
-            metadata_producer.enqueue_message(
-                {
-                    'identifier': identifier,
-                    'exif': exif
-                }
-            )
+    width, height = img.size
+    return {
+        'height': height,
+        'width': width,
+        'identifier': identifier,
+        'filesize': len(buf),
+        'compression_quality': jpeg_quality(buf)
+    }
+
+
+def exif_message(img: Image, identifier):
+    """ Collect EXIF metadata, or None if the image doesn't have any. """
+    # Pillow stores the raw APP1 segment at open time without parsing it, so
+    # checking for it first spares images without EXIF from the tag parser.
+    if 'exif' not in img.info:
+        return None
+    exif_tags = img.getexif()
+    if not exif_tags:
+        return None
+    # Binary values (such as maker notes) can't be encoded as JSON and are
+    # left out.
+    exif = {
+        f'0x{k:x}': _coerce_exif(v) for k, v in exif_tags.items()
+        if not isinstance(v, bytes)
+    }
+    return {
+        'identifier': identifier,
+        'exif': exif
+    }
+
+
+def _coerce_exif(value):
+    """ Convert rational EXIF values into JSON serializable floats. """
+    if isinstance(value, IFDRational):
+        return float(value)
+    if isinstance(value, tuple):
+        return [_coerce_exif(v) for v in value]
+    return value
 
 
 def notify_retry(identifier, source, url, attempts, retry_producer):
@@ -125,6 +167,6 @@ def notify_404(identifier, link_rot_producer):
     link_rot_producer.enqueue_message(
         {
             'identifier': identifier,
-            'timestamp': dt.datetime.utcnow().isoformat()
+            'timestamp': dt.datetime.utcnow()
         }
     )
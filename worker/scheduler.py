@@ -122,7 +122,7 @@ class CrawlScheduler:
     async def schedule_loop(self):
         """ Repeatedly schedule image processing tasks. """
         task_schedule = defaultdict(list)
-        semaphore = asyncio.BoundedSemaphore(settings.MAX_TASKS)
+        semaphore = asyncio.BoundedSemaphore(settings.MAX_INFLIGHT)
         if settings.PROFILE_MEMORY:
             from pympler import tracker
             self.memtrack = tracker.SummaryTracker()
@@ -170,14 +170,32 @@ async def setup_io():
         settings.AWS_DEFAULT_REGION,
         config=botocore.client.Config(max_pool_connections=settings.MAX_TASKS)
     )
-    producer = Producer({'bootstrap.servers': settings.KAFKA_HOSTS})
+    producer_settings = {
+        'bootstrap.servers': settings.KAFKA_HOSTS,
+        # Let librdkafka collect messages into large compressed batches
+        # instead of sending them to the broker one by one.
+        'linger.ms': 50,
+        'batch.num.messages': 10000,
+        'compression.type': 'lz4'
+    }
+    producer = Producer(producer_settings)
     metadata_producer = AsyncProducer(producer, 'image_metadata_updates')
     retry_producer = AsyncProducer(producer, 'inbound_images')
     link_rot_producer = AsyncProducer(producer, 'link_rot')
     redis_client = aredis.StrictRedis(host=settings.REDIS_HOST)
-    connector = aiohttp.TCPConnector(ssl=False)
+    # One session is shared by every download so that connections, TLS
+    # sessions, and DNS lookups are reused across images. The total number
+    # of connections is already bounded by the number of scheduled tasks.
+    connector = aiohttp.TCPConnector(
+        ssl=False,
+        limit=0,
+        limit_per_host=32,
+        ttl_dns_cache=300,
+        keepalive_timeout=60
+    )
+    timeout = aiohttp.ClientTimeout(total=30, sock_connect=5, sock_read=10)
     aiosession = RateLimitedClientSession(
-        aioclient=aiohttp.ClientSession(connector=connector),
+        aioclient=aiohttp.ClientSession(connector=connector, timeout=timeout),
         redis=redis_client
     )
     stats = StatsManager(redis_client)
@@ -219,7 +237,18 @@ async def listen():
         rot_producer_task,
         scheduler_task
     ]
-    await asyncio.wait(tasks)
+    # None of these tasks should ever finish. If one crashes, cancel the rest
+    # so the worker shuts down instead of running in a degraded state.
+    try:
+        done, _ = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_EXCEPTION
+        )
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in done:
+        task.result()
 
 
 if __name__ == '__main__':
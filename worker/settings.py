@@ -1,3 +1,4 @@
+import math
 import os
 
 true_strings = ['true', 'True', 't', '1']
@@ -26,4 +27,92 @@ SCHEDULE_SIZE = int(os.getenv('SCHEDULE_SIZE', '3000'))
 # be detrimental to performance.
 MAX_TASKS = 3000
 
+
+def _read_cgroup_file(path):
+    """ Read the whitespace separated fields of a cgroup control file. """
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except (OSError, ValueError):
+        return None
+
+
+def _physical_memory_mb():
+    try:
+        pages = os.sysconf('SC_PHYS_PAGES')
+        page_size = os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+    return pages * page_size // (1024 * 1024)
+
+
+def _memory_limit_mb():
+    """
+    Memory available to the worker, honoring the container's cgroup limit
+    (v2, then v1) before falling back to the host's physical memory.
+    """
+    physical = _physical_memory_mb()
+    limit = None
+    for path in ['/sys/fs/cgroup/memory.max',
+                 '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        fields = _read_cgroup_file(path)
+        if fields and fields[0].isdigit():
+            limit = int(fields[0]) // (1024 * 1024)
+            break
+    # cgroup v1 reports "unlimited" as a huge number.
+    if limit and physical:
+        return min(limit, physical)
+    return limit or physical
+
+
+def _cpu_limit():
+    """
+    CPUs available to the worker, honoring CPU affinity and the container's
+    cgroup CPU quota (v2, then v1).
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = period = None
+    fields = _read_cgroup_file('/sys/fs/cgroup/cpu.max')
+    if fields and len(fields) == 2 and fields[0] != 'max':
+        quota, period = fields
+    else:
+        quota_fields = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period_fields = _read_cgroup_file(
+            '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+        )
+        if quota_fields and period_fields:
+            quota, period = quota_fields[0], period_fields[0]
+    try:
+        quota, period = int(quota), int(period)
+    except (TypeError, ValueError):
+        return cpus
+    # A quota of -1 means no limit in cgroup v1.
+    if quota > 0 and period > 0:
+        cpus = min(cpus, max(1, math.ceil(quota / period)))
+    return cpus
+
+
+def _max_inflight(budget_mb, avg_image_mb, max_tasks):
+    """ Number of average sized images that fit into the memory budget. """
+    return max(1, min(max_tasks, int(budget_mb // avg_image_mb)))
+
+
+# Images larger than this are not downloaded.
+MAX_IMAGE_BYTES = int(os.getenv('MAX_IMAGE_BYTES', 25 * 1024 * 1024))
+
+# Number of images to download and process at the same time. Every in-flight
+# image is held in memory in full, so this is capped by how many average
+# sized images fit into the memory budget (half of the container's memory
+# limit by default).
+AVG_IMAGE_MB = float(os.getenv('AVG_IMAGE_MB', '5'))
+_default_budget = (_memory_limit_mb() or 8192) // 2
+MEMORY_BUDGET_MB = int(os.getenv('MEMORY_BUDGET_MB', _default_budget))
+MAX_INFLIGHT = _max_inflight(MEMORY_BUDGET_MB, AVG_IMAGE_MB, MAX_TASKS)
+
+# Number of processes used for decoding and thumbnailing images.
+IMAGE_PROCESSES = int(os.getenv('IMAGE_PROCESSES', _cpu_limit()))
+
 PROFILE_MEMORY = os.getenv('PROFILE_MEMORY', 'False') in true_strings
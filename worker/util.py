@@ -1,4 +1,90 @@
+import struct
 from io import BytesIO
+from typing import Optional
+
+# The standard luminance quantization table from the JPEG specification
+# (Annex K). libjpeg scales this table according to the requested quality.
+_STD_LUMINANCE_QUANT = [
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99
+]
+
+
+def _quant_table_sum(quality):
+    """ Sum of the luminance table libjpeg produces at a given quality. """
+    scale = 5000 // quality if quality < 50 else 200 - quality * 2
+    return sum(
+        min(max((q * scale + 50) // 100, 1), 255)
+        for q in _STD_LUMINANCE_QUANT
+    )
+
+
+_QUALITY_SUMS = [(q, _quant_table_sum(q)) for q in range(1, 101)]
+
+_SOI = b'\xff\xd8'
+_DQT = 0xdb
+_SOS = 0xda
+# Markers that stand alone and are not followed by a length field.
+_STANDALONE_MARKERS = {0x01} | set(range(0xd0, 0xd8))
+
+
+def jpeg_quality(buf: bytes) -> Optional[int]:
+    """
+    Estimate the quality setting a JPEG was encoded with by comparing its
+    luminance quantization table to the tables libjpeg generates for each
+    quality level. Only the headers are scanned; the image is not decoded.
+
+    :param buf: The encoded image.
+    :return: A quality between 1 and 100, or None if the image is not a JPEG
+    or has no luminance quantization table.
+    """
+    if not buf.startswith(_SOI):
+        return None
+    pos = 2
+    end = len(buf)
+    while pos + 4 <= end:
+        if buf[pos] != 0xff:
+            return None
+        marker = buf[pos + 1]
+        if marker == 0xff:
+            # Fill byte
+            pos += 1
+            continue
+        if marker in _STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker == _SOS:
+            return None
+        length, = struct.unpack_from('>H', buf, pos + 2)
+        segment_end = min(pos + 2 + length, end)
+        if marker == _DQT:
+            table_pos = pos + 4
+            while table_pos < segment_end:
+                precision = buf[table_pos] >> 4
+                table_id = buf[table_pos] & 0x0f
+                table_pos += 1
+                if precision:
+                    table_len = 128
+                    fmt = '>64H'
+                else:
+                    table_len = 64
+                    fmt = '64B'
+                if table_pos + table_len > segment_end:
+                    return None
+                if table_id == 0:
+                    table_sum = sum(struct.unpack_from(fmt, buf, table_pos))
+                    return min(
+                        _QUALITY_SUMS, key=lambda qs: abs(qs[1] - table_sum)
+                    )[0]
+                table_pos += table_len
+        pos = segment_end
+    return None
 
 
 def save_thumbnail_s3(s3_client, img: BytesIO, identifier):